@@ -18,6 +18,8 @@ or all the message files in a folder.
         [-v loggingLevel|--verbose=logingLevel]
         [-L logDir|--logDir=logDir]
         [-l logfile|--logfile=logfile]
+        [-e|--inlineErrors]
+        [-j jobs|--jobs=jobs]
         [-|filename]...
 
 
@@ -49,6 +51,14 @@ or all the message files in a folder.
 
     -l logfile|--logfile=logfile
     The name of a log file where you want all messages captured.
+
+    -e|--inlineErrors
+    Also add each validation error to the HL7 v2.xml XML message as an XML comment.
+    Validation errors are always written to the report file.
+
+    -j jobs|--jobs=jobs
+    The number of messages to validate in parallel, when validating all the message files in a folder
+    (default=1, 0=one per CPU).
 '''
 
 # pylint: disable=invalid-name, bare-except, pointless-string-statement, global-statement; superfluous-parens
@@ -59,6 +69,8 @@ import logging
 import argparse
 import re
 import csv
+import pickle
+import multiprocessing
 from xml.etree import ElementTree as et
 
 # This next section is plagurised from /usr/include/sysexits.h
@@ -86,39 +98,71 @@ segmentNo = 0           # The next segment in the message to be converted
 segmentRoot = None      # The XML Schema for the segments
 fieldRoot = None        # The XML Schema for the fields
 dataTypeRoot = None     # The XML Schema for the data types
-messageRoot = None      # The XML Schema for the message being converted
+messageGroups = None    # The sequence (or choice) of segments for each group in the message being converted
 namespaces = None       # The namespaces of the XML Schemas
 fieldSep = None         # The field separator character
 repSep = None           # The repeat separator
 compSep = None          # The component separator
 subCompSep = None       # The subcomponent separator
-xmlReplacements = [
-    re.compile(r'\\(H)\\'),
-    re.compile(r'\\(N)\\'),
-    re.compile(r'\\(\.br)\\'),
-    re.compile(r'\\(\.sp\s*\d+)\\'),
-    re.compile(r'\\(\.in\s*[-+]?\d+)\\'),
-    re.compile(r'\\(\.ti\s*[-+]?\d+)\\')
-]
-charXref = re.compile(r'\\X([0-9A-Fa-f][0-9A-Fa-f])+\\')
-charZref = re.compile(r'\\Z([0-9A-Fa-f][0-9A-Fa-f])+\\')
+hl7Escapes = re.compile(r'\\(?:[XZ](?P<hex>(?:[0-9A-Fa-f][0-9A-Fa-f])+)|(?P<format>H|N|\.br|\.sp\s*\d+|\.in\s*[-+]?\d+|\.ti\s*[-+]?\d+))\\')
+hexPair = re.compile(r'[0-9A-Fa-f]{2}')
+lineEnds = re.compile(r'\r\n|\r|\n')       # Any line ending, as standard input is not read with universal newlines
+snComparators = frozenset(['<', '>', '=', '<=', '>=', '<>'])      # The valid SN.1 comparators
+snSeparators = frozenset(['+', '-', '/', '.', ':'])         # The valid SN.3 separators/suffixes
 hl7charRef = re.compile(r'&amp;(#x([0-9A-Fa-f][0-9A-Fa-f])+;)')
-DTpattern = re.compile(r'^[12]\d{3}((0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])?)?$')
-DTMpattern = re.compile(r'^[12]\d{3}((0[1-9]|1[0-2])((0[1-9]|[12]\d|3[01])(([01]\d|2[0-4])([0-5]\d([0-5]\d(\.\d{1,4})?)?)?)?)?)?([-+]?(0\d|1[0-3])[0-5]\d)?$')
-NMpattern = re.compile(r'^[-+]?\d+(\.\d*)?$')
-RI2pattern = re.compile(r'^([01]\d|2[0-4])[0-5]\d(,([01]\d|2[0-4])[0-5]\d)*$')
-SIpattern = re.compile(r'^\d{1,4}$')
-TMpattern = re.compile(r'^([01]\d|2[0-4])([0-5]\d([0-5]\d(\.\d{1,4})?)?)?([-+]?(0\d|1[0-3])[0-5]\d)?$')
-TNpattern = re.compile(r'^(\d\d)?((\d{3}))?\d{3}-\d{4}(X\d{4})?(B\d{4})?(C.*)?$')
-TS2pattern = re.compile(r'^[YLDMHS]$')
-Hexpattern = re.compile(r'^[A-Fa-f0-9]*$')
-Base64pattern = re.compile(r'^[A-Za-z0-9+/]={0,2}$')
+DTpattern = re.compile(r'[12]\d{3}((0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])?)?')
+DTMpattern = re.compile(r'[12]\d{3}((0[1-9]|1[0-2])((0[1-9]|[12]\d|3[01])(([01]\d|2[0-4])([0-5]\d([0-5]\d(\.\d{1,4})?)?)?)?)?)?([-+]?(0\d|1[0-3])[0-5]\d)?')
+NMpattern = re.compile(r'[-+]?\d+(\.\d*)?')
+RI2pattern = re.compile(r'([01]\d|2[0-4])[0-5]\d(,([01]\d|2[0-4])[0-5]\d)*')
+SIpattern = re.compile(r'\d{1,4}')
+TMpattern = re.compile(r'([01]\d|2[0-4])([0-5]\d([0-5]\d(\.\d{1,4})?)?)?([-+]?(0\d|1[0-3])[0-5]\d)?')
+TNpattern = re.compile(r'(\d\d)?((\d{3}))?\d{3}-\d{4}(X\d{4})?(B\d{4})?(C.*)?')
+TS2pattern = re.compile(r'[YLDMHS]')
+Hexpattern = re.compile(r'[A-Fa-f0-9]+')
+Base64pattern = re.compile(r'[A-Za-z0-9+/]+={0,2}')
+# The check (a function that returns a true value for valid text) and error message for data types with a known format
+textTypeChecks = {
+    'DT': (DTpattern.fullmatch, 'Illegally formated date "{}"'),
+    'DTM': (DTMpattern.fullmatch, 'Illegally formatted date/time "{}"'),
+    'NM': (NMpattern.fullmatch, 'Illegally formatted number "{}"'),
+    'SI': (SIpattern.fullmatch, 'Illegally formatted sequence identifier "{}"'),
+    'SN.1': (snComparators.__contains__, 'Illegally formatted numeric comparitor "{}"'),
+    'TM': (TMpattern.fullmatch, 'Illegally formatted time "{}"'),
+    'TN': (TNpattern.fullmatch, 'Illegally formatted telephone number "{}"'),
+}
+# The check and error message for components with a known format, keyed by (parent data type, sequence)
+parentTypeChecks = {
+    ('ED', 4): (frozenset(['Hex', 'Base64']).__contains__, 'Illegal Encapsulated Data encoding "{}"'),
+    ('RI', 2): (RI2pattern.fullmatch, 'Illegally formatted time interval "{}"'),
+    ('SN', 3): (snSeparators.__contains__, 'Illegally formatted numeric separator/suffix "{}"'),
+    ('TS', 1): (DTMpattern.fullmatch, 'Illegally formatted date/time "{}"'),
+    ('TS', 2): (TS2pattern.fullmatch, 'Illegally formatted time degree of precission "{}"'),
+    ('XTN', 1): (TNpattern.fullmatch, 'Illegally formatted telephone number "{}"'),
+}
 msgStruct = None
+schemaDir = None        # The folder containing the HL7 v2.xml XML Schema files and tables
+xsdDir = None           # The folder containing the HL7 v2.xml XML Schema files
+inputDir = None         # The folder containing the HL7 v2.x vertical bar encoded message files
+reportDir = None        # The folder where the report files are created
+outputDir = None        # The folder where the HL7 v2.xml XML messages are created
+hl7messageStructures = None     # The message structure for each message type and trigger event
 reportFile = None       # The report file
+validationErrors = []   # The validation errors for the message being validated
+inlineErrors = False    # Whether validation errors are also added to the HL7 v2.xml XML message as comments
 hl7Tables = None        # The HL7 and User tables
 fieldLengths = None     # The maximum length of any field
 datatypeLengths = None  # The maxiumum lenght of an datatype component
 valueSets = None        # The value sets for CE, CF, CNE and CWE coded elements
+segmentSequences = None     # The sequence of fields for each segment
+fieldAttributes = None      # The Type and Table attributes for each field
+dataTypeSequences = None    # The sequence of components for each data type
+dataTypeAttributes = None   # The Type and Table attributes for each data type component
+sequenceIndexes = {}        # The segment dispatch table for each message structure sequence
+messageSchemas = {}         # The segment sequence and groups for each message structure, once read
+variesFields = {'OBX': (4, 1), 'MFE': (3, 4)}   # The field of type 'varies' in a segment, and the field holding its actual data type
+triggerNumbers = [f'{eachNumber:02d}' for eachNumber in range(100)]        # The two digit numbers used in trigger event ranges
+tableFiles = ['hl7Table0354.csv', 'hl7Tables.csv', 'hl7Fields.csv', 'hl7DataTypes.csv', 'valueSets.csv']      # The table files in the schema folder
+tablesCacheFile = 'hl7Tables.pickle'       # The cache of the tables read from the table files, in the schema folder
 
 
 
@@ -126,404 +170,539 @@ def getDocument(fileName):
     '''
     Get an HL7 vertical bar message from a file or standard input
     '''
-    thisHL7message = ''
     if fileName == '-':     # Use standard input
-        for line in sys.stdin:
-            thisHL7message += line.rstrip() + '\n'
-        return thisHL7message
-    if not os.path.isfile(fileName):
-        logging.fatal('No file named %s', fileName)
-        logging.shutdown()
-        sys.exit(EX_CONFIG)
-    with open(fileName, 'rt', encoding='utf-8') as fpin:
-        for line in fpin:
-            thisHL7message += line.rstrip() + '\r'
-        return thisHL7message
+        thisHL7message = sys.stdin.read()
+    else:
+        if not os.path.isfile(fileName):
+            logging.fatal('No file named %s', fileName)
+            logging.shutdown()
+            sys.exit(EX_CONFIG)
+        with open(fileName, 'rt', encoding='utf-8') as fpin:
+            thisHL7message = fpin.read()
+    # Remove any MLLP framing - a leading VT and a trailing FS, CR (which may have become a \n)
+    if thisHL7message.startswith(chr(11)) and thisHL7message.rstrip('\r\n').endswith(chr(28)):
+        thisHL7message = thisHL7message[1:].rstrip('\r\n')[:-1]
+    # Each line is a segment - a file read in text mode has universal newlines, but standard input can still contain \r or \r\n
+    return '\r'.join(line.rstrip() for line in lineEnds.split(thisHL7message))
+
+
+def getSequences(schemaRoot, suffix):
+    '''
+    Index the xsd:sequence of every named xsd:complexType in an HL7 v2.xml XML Schema
+    PARAMETERS:
+        schemaRoot - et.Element, the root element of the XML Schema
+        suffix - str, the suffix to remove from the complexType name (e.g. '.CONTENT')
+    RETURNS:
+        dict, the list of xsd:element children of the xsd:sequence, keyed by complexType name
+    '''
+    sequences = {}
+    for complexType in schemaRoot.findall('xsd:complexType', namespaces):
+        if 'name' not in complexType.attrib:
+            continue
+        name = sys.intern(complexType.attrib['name'].removesuffix(suffix))
+        if name in sequences:
+            continue
+        sequence = complexType.find('xsd:sequence', namespaces)
+        if sequence is not None:
+            for element in sequence:        # The refs become XML element tags, so intern them
+                if 'ref' in element.attrib:
+                    element.attrib['ref'] = sys.intern(element.attrib['ref'])
+            sequences[name] = list(sequence)
+    return sequences
+
+
+def getGroups(schemaRoot):
+    '''
+    Index the xsd:sequence or xsd:choice of every named xsd:complexType in a message structure XML Schema
+    PARAMETERS:
+        schemaRoot - et.Element, the root element of the message structure XML Schema
+    RETURNS:
+        dict, the tuple (xsd:sequence or xsd:choice element, isChoice) keyed by complexType name, less the '.CONTENT' suffix
+    '''
+    groups = {}
+    for complexType in schemaRoot.findall('xsd:complexType', namespaces):
+        if 'name' not in complexType.attrib:
+            continue
+        name = sys.intern(complexType.attrib['name'].removesuffix('.CONTENT'))
+        if name in groups:
+            continue
+        sequence = complexType.find('xsd:sequence', namespaces)
+        if sequence is not None:
+            groups[name] = (sequence, False)
+            continue
+        choice = complexType.find('xsd:choice', namespaces)
+        if choice is not None:
+            groups[name] = (choice, True)
+    return groups
+
+
+def getAttributes(schemaRoot):
+    '''
+    Index the fixed Type and Table attributes of every named xsd:attributeGroup in an HL7 v2.xml XML Schema
+    PARAMETERS:
+        schemaRoot - et.Element, the root element of the XML Schema
+    RETURNS:
+        dict, the tuple (Type, Table) keyed by attributeGroup name, less the '.ATTRIBUTES' suffix
+        Type and/or Table will be None if not defined in the attributeGroup
+    '''
+    attributes = {}
+    for attributeGroup in schemaRoot.findall('xsd:attributeGroup', namespaces):
+        if 'name' not in attributeGroup.attrib:
+            continue
+        name = sys.intern(attributeGroup.attrib['name'].removesuffix('.ATTRIBUTES'))
+        if name in attributes:
+            continue
+        thisType = attributeGroup.find("xsd:attribute[@name='Type']", namespaces)
+        if (thisType is not None) and ('fixed' in thisType.attrib):
+            attributeType = sys.intern(thisType.attrib['fixed'])
+        else:
+            attributeType = None
+        thisTable = attributeGroup.find("xsd:attribute[@name='Table']", namespaces)
+        if (thisTable is not None) and ('fixed' in thisTable.attrib):
+            attributeTable = thisTable.attrib['fixed']
+        else:
+            attributeTable = None
+        attributes[name] = (attributeType, attributeTable)
+    return attributes
+
+
+def indexSequence(sequenceList):
+    '''
+    Get the segment dispatch table for a message structure sequence (or choice), building it the first time
+    PARAMETERS:
+        sequenceList - et.Element, the XML sequence from the message structure XSD
+    RETURNS:
+        segmentPositions - dict, the positions in the sequence of each segment (or group) ref
+        runEnds - list, for each position, the position of the next required segment or group
+                  i.e. the end of the run of optional segments starting at that position
+        maxOccurs - list, for each position, the maximum number of consecutive occurrences (None if unbounded)
+    '''
+    if sequenceList in sequenceIndexes:
+        return sequenceIndexes[sequenceList]
+    segmentPositions = {}
+    maxOccurs = []
+    for position, element in enumerate(sequenceList):
+        if 'ref' in element.attrib:
+            element.attrib['ref'] = sys.intern(element.attrib['ref'])
+            segmentPositions.setdefault(element.attrib['ref'], []).append(position)
+        thisMax = element.attrib.get('maxOccurs', '1')
+        if thisMax.isdigit():       # Not 'unbounded'
+            maxOccurs.append(int(thisMax))
+        else:
+            maxOccurs.append(None)
+    runEnds = [len(sequenceList)] * (len(sequenceList) + 1)
+    for position in range(len(sequenceList) - 1, -1, -1):
+        attrib = sequenceList[position].attrib
+        if ('ref' not in attrib) or (len(attrib['ref']) > 3) or (attrib.get('minOccurs') != '0'):
+            runEnds[position] = position
+        else:
+            runEnds[position] = runEnds[position + 1]
+    sequenceIndexes[sequenceList] = (segmentPositions, runEnds, maxOccurs)
+    return segmentPositions, runEnds, maxOccurs
+
+
+def reportError(xmlElement, comment):
+    '''
+    Record a validation error for the report file
+    and, if requested, add it to the HL7 v2.xml XML message as a comment
+    PARAMETERS:
+        xmlElement - et.Element, the element in the HL7 v2.xml XML message that is in error
+        comment - str, the validation error
+    '''
+    validationErrors.append(comment)
+    if inlineErrors:
+        xmlElement.append(et.Comment(comment))
 
 
-def validateXML(sequenceList, tag, optional, isChoice, depth):
+def validateXML(sequenceList, tag):
     '''
     Output an XML structure for all the elements in the sequence list where we have a matching segment in the Segments.
     If there is no matching segment then report a validation error and output the segment as an XML comment.
     PARAMETERS:
-        xmlElement - et.Element, the current element we are working on
-        sequenceList - et.Element,the XML sequence we are working on, from the message structure XSD
-        sequenceAt - int, how far we are through this sequence list
-        tag - str, the group tag, if any
-        optional - boolean whether no output is valid
-        depth - int, the recursion depth
-    This is a recursive routine, so we use depth to prevent indifinite recurrsion
+        sequenceList - et.Element, the XML sequence we are working on, from the message structure XSD
+        tag - str, the message structure tag
+    RETURNS:
+        et.Element, the HL7 v2.xml XML message (or None if no segment matched)
+    Groups are validated by saving the state of the enclosing sequence on a stack (rather than by recursion)
+    and restoring it when the group is finished. The depth of the stack is limited, in case a group contains itself.
     '''
 
     global segmentNo
 
-    if depth > 200:
-        # Treat this segment as unexpected
-        comment= f'Unexpected Segment at {segmentNo + 1:d} - "{Segments[segmentNo]}"'
-        print(comment, file=reportFile)
-        newElement = et.Element(tag)
-        newElement.append(et.Comment(comment))
-        segmentNo += 1
-        return newElement
-    depth += 1
+    groupStack = []
+    optional = False        # Whether no output is valid for this sequence
+    isChoice = False        # Whether this sequence is an xsd:choice
+    segmentPositions, runEnds, maxOccurs = indexSequence(sequenceList)
     sequenceAt = 0
     thisElement = None
-    tagged = False
     occurs = 0
     lastSeg = None
-    while sequenceAt < len(sequenceList):           # Check the next segment
-        if 'ref' not in sequenceList[sequenceAt].attrib:
-            logging.critical('XML Schema definition is missing "ref" for segment at %d in message struct %s', sequenceAt, msgStruct)
-            logging.shutdown()
-            sys.exit(EX_CONFIG)
-        if sequenceList[sequenceAt].attrib['ref'] != Segments[segmentNo][0:3]:
-            # Check if this segment is here, after some optional segments
-            if len(sequenceList[sequenceAt].attrib['ref']) > 3:     # A group
-                groupRef = sequenceList[sequenceAt].attrib['ref']
-                groupOptional = False
-                if 'minOccurs' not in sequenceList[sequenceAt]:
-                    logging.critical('XML Schema definition is missing "minOccurs" at %d in message struct %s', sequenceAt, msgStruct)
-                    logging.shutdown()
-                    sys.exit(EX_CONFIG)
-                if sequenceList[sequenceAt].attrib['minOccurs'] == '0':
-                    groupOptional = True
-                thisChoice = False
-                groupList = messageRoot.find("xsd:complexType[@name='" + groupRef + ".CONTENT']/xsd:sequence", namespaces)
-                if groupList is None:
-                    groupList = messageRoot.find("xsd:complexType[@name='" + groupRef + ".CONTENT']/xsd:choice", namespaces)
-                    thisChoice = True
+    while True:
+        groupList = None
+        while sequenceAt < len(sequenceList):           # Check the next segment
+            sequenceAttrib = sequenceList[sequenceAt].attrib
+            if 'ref' not in sequenceAttrib:
+                logging.critical('XML Schema definition is missing "ref" for segment at %d in message struct %s', sequenceAt, msgStruct)
+                logging.shutdown()
+                sys.exit(EX_CONFIG)
+            sequenceRef = sequenceAttrib['ref']
+            thisSegment = Segments[segmentNo]
+            seg = thisSegment[0:3]
+            if sequenceRef != seg:
+                # Check if this segment is here, after some optional segments
+                if len(sequenceRef) > 3:     # A group
+                    groupRef = sequenceRef
+                    groupOptional = False
+                    if 'minOccurs' not in sequenceAttrib:
+                        logging.critical('XML Schema definition is missing "minOccurs" at %d in message struct %s', sequenceAt, msgStruct)
+                        logging.shutdown()
+                        sys.exit(EX_CONFIG)
+                    if sequenceAttrib['minOccurs'] == '0':
+                        groupOptional = True
+                    groupList, thisChoice = messageGroups.get(groupRef, (None, False))
                     if groupList is None:
                         logging.critical('XML Schema definition missing either xsd:sequence or xsd:choice for %s', groupRef + '.CONTENT')
                         logging.shutdown()
                         sys.exit(EX_CONFIG)
-                groupXML = validateXML(groupList, groupRef, groupOptional, thisChoice, depth)           # Validate this group of segments
-                if groupXML is not None:        # At least one segment was found at in this group
-                    if not tagged:
-                        thisElement = et.Element(tag)
-                        tagged = True
-                    thisElement.append(groupXML)
-                    if segmentNo < len(Segments):       # More to do
-                        continue
-                    return thisElement
-                # Nothing found - make sure group is optional and skip if it is
-                if sequenceList[sequenceAt].attrib['minOccurs'] == '0':
-                    sequenceAt += 1
+                    break       # Validate this group of segments
+                # Check if this segment is optional
+                if sequenceAttrib['minOccurs'] == '0':
+                    # Skip to this segment, if it is in this run of optional segments, else to the end of the run
+                    nextAt = runEnds[sequenceAt]
+                    for position in segmentPositions.get(seg, []):
+                        if position > sequenceAt:
+                            nextAt = min(position, nextAt)
+                            break
+                    sequenceAt = nextAt
                     continue
-                return thisElement
-            # Check if this segment is optional
-            if sequenceList[sequenceAt].attrib['minOccurs'] == '0':
-                sequenceAt += 1
-                continue
-            # This is some sort of failure something, that is this segment isrequire and is not present
-            # If this sequence is optional, then return what we have
-            if optional:
-                return thisElement
-            # Otherwise, treat this segment as 'unexpected'
-            comment= f'Unexpected Segment at {segmentNo + 1:d}: "{Segments[segmentNo]}"'
-            print(comment, file=reportFile)
-            if not tagged:
+                # This is some sort of failure something, that is this segment isrequire and is not present
+                # If this sequence is optional, then return what we have
+                if optional:
+                    break
+                # Otherwise, treat this segment as 'unexpected'
+                comment= f'Unexpected Segment at {segmentNo + 1:d}: "{thisSegment}"'
+                if thisElement is None:
+                    thisElement = et.Element(tag)
+                reportError(thisElement, comment)
+                segmentNo += 1
+                if segmentNo < len(Segments):
+                    continue
+                break
+            # A matching segment
+            if (lastSeg is None) or (lastSeg != seg):
+                lastSeg = seg
+                occurs = 0
+            if thisElement is None:
                 thisElement = et.Element(tag)
-                tagged = True
-            thisElement.append(et.Comment(comment))
+            validateSegment(et.SubElement(thisElement, sequenceRef), thisSegment)
             segmentNo += 1
-            if segmentNo < len(Segments):
+            if segmentNo == len(Segments):
+                break
+            if isChoice:
+                break
+            occurs += 1
+            thisMax = maxOccurs[sequenceAt]
+            if (thisMax is None) or (occurs < thisMax):
                 continue
-            return thisElement
-        # A matching segment
-        seg = Segments[segmentNo][0:3]
-        if (lastSeg is None) or (lastSeg != seg):
-            lastSeg = seg
+            sequenceAt += 1
+        if groupList is not None:
+            # Save this sequence and start validating the group
+            groupStack.append((sequenceList, tag, optional, isChoice, segmentPositions, runEnds, maxOccurs, sequenceAt, thisElement, occurs, lastSeg))
+            sequenceList, tag, optional, isChoice = groupList, groupRef, groupOptional, thisChoice
+            sequenceAt = 0
+            thisElement = None
             occurs = 0
-        if not tagged:
+            lastSeg = None
+            if len(groupStack) <= 200:
+                segmentPositions, runEnds, maxOccurs = indexSequence(sequenceList)
+                continue
+            # Too deep - treat this segment as unexpected
+            comment= f'Unexpected Segment at {segmentNo + 1:d} - "{Segments[segmentNo]}"'
             thisElement = et.Element(tag)
-            tagged = True
-        segElement = et.Element(seg)
-        Fields = Segments[segmentNo].split(fieldSep)            # Split this segment into fields
-        if Fields[0] == 'MSH':
-            Fields.insert(1, fieldSep)
-        seg = Fields[0]
-        Fields = Fields[1:]
-        xmlSeg = segmentRoot.find("xsd:complexType[@name='" + seg + ".CONTENT']/xsd:sequence", namespaces)
-        if xmlSeg is None:
-            logging.critical('XML Schema is missing segment definition for segment %s', seg)
-            logging.shutdown()
-            sys.exit(EX_CONFIG)
-        for i, field in enumerate(Fields):          # Process each field
-            fieldCode = f'{seg}-{i + 1:d}'
-            if (i < len(xmlSeg)) and ('ref' in xmlSeg[i].attrib) and ('minOccurs' in xmlSeg[i].attrib) and ('maxOccurs' in xmlSeg[i].attrib):
-                fieldRef = xmlSeg[i].attrib['ref']
-                thisMin = xmlSeg[i].attrib['minOccurs']
-                try:
-                    fieldMin = int(fieldMin)
-                except:
-                    fieldMin = None
-                thisMax = xmlSeg[i].attrib['maxOccurs']
-                try:
-                    if thisMax == 'unbounded':
-                        fieldMax = None
-                    else:
-                        fieldMax = int(thisMax)
-                except:
-                    fieldMax = None
-                fieldXML = et.Element(fieldRef)
-                thisType = fieldRoot.find("xsd:attributeGroup[@name='" + fieldRef + ".ATTRIBUTES']/xsd:attribute[@name='Type']", namespaces)
-                if (thisType is not None) and ('fixed' in thisType.attrib):
-                    fieldType = thisType.attrib['fixed']
-                else:
-                    fieldType = None                    
-                thisTable = fieldRoot.find("xsd:attributeGroup[@name='" + fieldRef + ".ATTRIBUTES']/xsd:attribute[@name='Table']", namespaces)
-                if (thisTable is not None) and ('fixed' in thisTable.attrib):
-                    fieldTable = thisTable.attrib['fixed']
-                else:
-                    fieldTable = None                    
+            reportError(thisElement, comment)
+            segmentNo += 1
+        # This sequence is finished - return what we have to the enclosing sequence
+        groupXML = thisElement
+        while groupStack:
+            groupOptional = optional
+            sequenceList, tag, optional, isChoice, segmentPositions, runEnds, maxOccurs, sequenceAt, thisElement, occurs, lastSeg = groupStack.pop()
+            if groupXML is not None:        # At least one segment was found at in this group
+                if thisElement is None:
+                    thisElement = et.Element(tag)
+                thisElement.append(groupXML)
+                if segmentNo < len(Segments):       # More to do
+                    break
+            elif groupOptional:         # Nothing found - skip this group as it is optional
+                sequenceAt += 1
+                break
+            groupXML = thisElement          # And the enclosing sequence is finished too
+        else:
+            return groupXML
+
+
+def validateSegment(segElement, thisSegment):
+    '''
+    Validate one segment, adding the fields, components and subcomponents to the segment's XML element
+    PARAMETERS:
+        segElement - et.Element, the XML element for this segment
+        thisSegment - str, the HL7 v2.x vertical bar encoded segment
+    '''
+
+    Fields = thisSegment.split(fieldSep)            # Split this segment into fields
+    seg = sys.intern(Fields[0])
+    if seg == 'MSH':            # MSH.1 is the field separator, so it takes the place of the segment name
+        Fields[0] = fieldSep
+    else:
+        del Fields[0]
+    xmlSeg = segmentSequences.get(seg)
+    if xmlSeg is None:
+        logging.critical('XML Schema is missing segment definition for segment %s', seg)
+        logging.shutdown()
+        sys.exit(EX_CONFIG)
+    variesAt, variesType = variesFields.get(seg, (None, None))
+    inSegment = f'in Segment {seg} at segment {segmentNo + 1:d}'          # Where this segment is, for the validation error messages
+    numFields = len(xmlSeg)
+    for i, field in enumerate(Fields):          # Process each field
+        fieldCode = f'{seg}-{i + 1:d}'
+        if i < numFields:
+            fieldAttrib = xmlSeg[i].attrib
+        else:
+            fieldAttrib = {}
+        if ('ref' in fieldAttrib) and ('minOccurs' in fieldAttrib) and ('maxOccurs' in fieldAttrib):
+            fieldRef = fieldAttrib['ref']
+            thisMin = fieldAttrib['minOccurs']
+            if thisMin.isdigit():
+                fieldMin = int(thisMin)
             else:
-                fieldRef = None
                 fieldMin = None
-                fieldMax = None
-                fieldXML = et.Element(fieldCode)
-                fieldType = 'ST'
-                fieldTable = None
-            if field == '':
-                if (fieldMin is not None) and (fieldMin > 0):
-                    comment = f'Missing required field [{fieldCode}] in Segment {seg} at segment {segmentNo + 1:d}'
-                    print(comment, file=reportFile)
-                    fieldXML.append(et.Comment(comment))
-                    segElement.append(fieldXML)
-                continue
-            if (seg == 'MSH') and (i == 1):         # Split this field into repetitions - except the encoding characters and FT data
-                fieldReps = [field]
-            elif fieldType == 'FT':
-                fieldReps = [field]
+            thisMax = fieldAttrib['maxOccurs']
+            if thisMax.isdigit():       # Not 'unbounded'
+                fieldMax = int(thisMax)
             else:
-                fieldReps = field.split(repSep)
-            for j, thisField in enumerate(fieldReps):
-                if thisField == '""':
-                    continue
-                if (fieldMax is not None) and (fieldMax <= j):
+                fieldMax = None
+            fieldXML = et.Element(fieldRef)
+            fieldType, fieldTable = fieldAttributes.get(fieldRef, (None, None))
+        else:
+            fieldRef = None
+            fieldMin = None
+            fieldMax = None
+            fieldXML = et.Element(fieldCode)
+            fieldType = 'ST'
+            fieldTable = None
+        if field == '':
+            if (fieldMin is not None) and (fieldMin > 0):
+                comment = f'Missing required field [{fieldCode}] {inSegment}'
+                reportError(fieldXML, comment)
+                segElement.append(fieldXML)
+            continue
+        if (seg == 'MSH') and (i == 1):         # Split this field into repetitions - except the encoding characters and FT data
+            fieldReps = [field]
+        elif fieldType == 'FT':
+            fieldReps = [field]
+        else:
+            fieldReps = field.split(repSep)
+        if (fieldMax is not None) and (len(fieldReps) > fieldMax):      # Report any unexpected repetitions (which are still validated)
+            for j in range(fieldMax, len(fieldReps)):
+                if fieldReps[j] != '""':
                     comment = f'Unexpected field repeat [{j + 1}] in segment {seg} at segment {segmentNo + 1:d} in field [{fieldCode}]'
-                    print(comment, file=reportFile)
-                    fieldXML.append(et.Comment(comment))
-                if fieldRef is not None:
-                    if fieldType is None:
-                        comment = f'Undefined Field in Segment {seg} at {segmentNo:%d}, field {fieldCode}'
-                        print(comment, file=reportFile)
-                        fieldXML.append(et.Comment(comment))
-                        fieldXML.text = thisField
+                    reportError(fieldXML, comment)
+        if (fieldRef is not None) and (fieldType is not None):        # Find the components of this field's data type
+            if (i == variesAt) and (fieldType == 'varies') and (variesType < len(Fields)):
+                fieldType = Fields[variesType]
+            if fieldType == 'FT':       # FT has a sequence, but not components
+                dataTypeBits = None
+            else:
+                dataTypeBits = dataTypeSequences.get(fieldType)
+        if valueSets is not None:       # The coding systems for this field, if it is a coded field
+            fieldCodingSystems = valueSets.get(fieldCode)
+        else:
+            fieldCodingSystems = None
+        for j, thisField in enumerate(fieldReps):
+            if thisField == '""':
+                continue
+            if fieldRef is not None:
+                if fieldType is None:
+                    comment = f'Undefined Field in Segment {seg} at {segmentNo + 1:d}, field {fieldCode}'
+                    reportError(fieldXML, comment)
+                    fieldXML.text = thisField
+                    if thisField != '':         # An empty repetition has nothing to check
                         comment = fixElement(fieldXML, 'ST', None, None, None)
                         if comment is not None:
-                            comment += f' in Segment {seg} at segment {segmentNo + 1:d} in field [{fieldCode}]'
-                            print(comment, file=reportFile)
-                            fieldXML.append(et.Comment(comment))
-                        segElement.append(fieldXML)
-                        continue
-                    if fieldType == 'varies':
-                        if (seg == 'OBX') and (fieldRef == 'OBX.5'):
-                            fieldType = Fields[1]
-                        elif (seg == 'MFE') and (fieldRef == 'MFE.4') and (len(Fields) > 4):
-                            fieldType = Fields[4]
-                    dataTypeBits = dataTypeRoot.find("xsd:complexType[@name='" + fieldType + "']/xsd:sequence", namespaces)
-                    if fieldType == 'FT':       # FT has a sequence, but not components
-                        dataTypeBits = None
-                    if dataTypeBits is not None:
-                        Components = thisField.split(compSep)
-                        for k, component in enumerate(Components):
-                            if component == '""':
-                                continue
-                            componentCode = f'{seg}-{i + 1:d}.{k + 1:d}'
-                            if (k < len(dataTypeBits)) and ('ref' in dataTypeBits[k].attrib) and ('minOccurs' in dataTypeBits[k].attrib):
-                                componentRef = dataTypeBits[k].attrib['ref']
-                                thisMin = dataTypeBits[k].attrib['minOccurs']
-                                try:
-                                    componentMin = int(thisMin)
-                                except:
-                                    componentMin = None
-                                componentXML = et.Element(componentRef)
-                                thisType = dataTypeRoot.find("xsd:attributeGroup[@name='" + componentRef + ".ATTRIBUTES']/xsd:attribute[@name='Type']", namespaces)
-                                if (thisType is not None) and ('fixed' in thisType.attrib):
-                                    componentType = thisType.attrib['fixed']
-                                else:
-                                    componentType = None                    
-                                thisTable = dataTypeRoot.find("xsd:attributeGroup[@name='" + componentRef + ".ATTRIBUTES']/xsd:attribute[@name='Table']", namespaces)
-                                if (thisTable is not None) and ('fixed' in thisTable.attrib):
-                                    componentTable = thisTable.attrib['fixed']
-                                else:
-                                    componentTable = None                    
+                            comment += f' {inSegment} in field [{fieldCode}]'
+                            reportError(fieldXML, comment)
+                    segElement.append(fieldXML)
+                    continue
+                if dataTypeBits is not None:
+                    Components = thisField.split(compSep)
+                    numComponents = len(dataTypeBits)
+                    for k, component in enumerate(Components):
+                        if component == '""':
+                            continue
+                        if k < numComponents:
+                            componentAttrib = dataTypeBits[k].attrib
+                        else:
+                            componentAttrib = {}
+                        if ('ref' in componentAttrib) and ('minOccurs' in componentAttrib):
+                            componentRef = componentAttrib['ref']
+                            thisMin = componentAttrib['minOccurs']
+                            if thisMin.isdigit():
+                                componentMin = int(thisMin)
                             else:
-                                componentRef = None
                                 componentMin = None
-                                componentXML = et.Element(componentCode)
-                                componentType = 'ST'
-                                componentTable = None
-                            if component == '':
-                                if (componentMin is not None) and (componentMin > 0):
-                                    comment = f'Missing required component [{componentCode}] in Segment {seg} at segment {segmentNo + 1:d}, field [{fieldCode}], repeat {j + 1:d}'
-                                    print(comment, file=reportFile)
-                                    componentXML.append(et.Comment(comment))
-                                    fieldXML.append(componentXML)
+                            componentXML = et.Element(componentRef)
+                            componentType, componentTable = dataTypeAttributes.get(componentRef, (None, None))
+                        else:
+                            componentRef = None
+                            componentMin = None
+                            componentCode = f'{seg}-{i + 1:d}.{k + 1:d}'
+                            componentXML = et.Element(componentCode)
+                            componentType = 'ST'
+                            componentTable = None
+                        if component == '':
+                            if (componentMin is not None) and (componentMin > 0):
+                                componentCode = f'{seg}-{i + 1:d}.{k + 1:d}'
+                                comment = f'Missing required component [{componentCode}] {inSegment}, field [{fieldCode}], repeat {j + 1:d}'
+                                reportError(componentXML, comment)
+                                fieldXML.append(componentXML)
+                            continue
+                        if componentRef is not None:
+                            if componentType is None:
+                                componentCode = f'{seg}-{i + 1:d}.{k + 1:d}'
+                                comment = f'Undefined component {inSegment}, field [{fieldCode}], repetition {j + 1:d}, component [{componentCode}]'
+                                reportError(componentXML, comment)
+                                componentXML.text = component
+                                comment = fixElement(componentXML, 'ST', fieldType, k + 1, Components)
+                                if comment is not None:
+                                    comment += f' {inSegment} in field [{fieldCode}], repetition {j + 1:d}, component [{componentCode}]'
+                                    reportError(componentXML, comment)
+                                fieldXML.append(componentXML)
                                 continue
-                            if componentRef is not None:
-                                if componentType is None:
-                                    comment = f'Undefined component in Segment {seg} at segment {segmentNo + 1:d}, field [{fieldCode}], repetition {j + 1:d}, component [{componentCode}]'
-                                    print(comment, file=reportFile)
-                                    componentXML.append(et.Comment(comment))
-                                    componentXML.text = component
-                                    comment = fixElement(componentXML, 'ST', fieldType, k + 1, fieldXML)
-                                    if comment is not None:
-                                        comment += f' in Segment {seg} at segment {segmentNo + 1:d} in field [{fieldCode}], repetition {j+ 1:d}, component [{componentCode}]'
-                                        print(comment, file=reportFile)
-                                        componentXML.append(et.Comment(comment))
-                                    fieldXML.append(componentXML)
-                                    continue
-                                componentBits = dataTypeRoot.find("xsd:complexType[@name='" + componentType + "']/xsd:sequence", namespaces)
-                                componentXML = et.Element(componentRef)
-                                if (componentBits is not None) and (subCompSep != '') and (componentCode != 'OBX.3.1'):
-                                    subComponents = component.split(subCompSep)
-                                    for l, subComponent in enumerate(subComponents):
-                                        if subComponent == '""':
-                                            continue
-                                        subCompCode = f'{seg}-{i + 1:d}.{k + 1:d}.{l + 1:d}'
-                                        if (l < len(componentBits)) and ('ref' in componentBits[l].attrib) and ('minOccurs' in componentBits[l].attrib):
-                                            subCompRef = componentBits[l].attrib['ref']
-                                            thisMin = componentBits[l].attrib['minOccurs']
-                                            try:
-                                                subCompMin = int(thisMin)
-                                            except:
-                                                subCompMin = None
-                                            subComponentXML = et.Element(subCompRef)
-                                            thisType = dataTypeRoot.find("xsd:attributeGroup[@name='" + subCompRef + ".ATTRIBUTES']/xsd:attribute[@name='Type']", namespaces)
-                                            if (thisType is not None) and ('fixed' in thisType.attrib):
-                                                subCompType = thisType.attrib['fixed']
-                                            else:
-                                                subCompType = None                    
-                                            thisTable = dataTypeRoot.find("xsd:attributeGroup[@name='" + subCompRef + ".ATTRIBUTES']/xsd:attribute[@name='Table']", namespaces)
-                                            if (thisTable is not None) and ('fixed' in thisTable.attrib):
-                                                subCompTable = thisTable.attrib['fixed']
-                                            else:
-                                                subCompTable = None                    
+                            componentBits = dataTypeSequences.get(componentType)
+                            if (componentBits is not None) and (subCompSep != '') and (f'{seg}-{i + 1:d}.{k + 1:d}' != 'OBX-3.1'):
+                                subComponents = component.split(subCompSep)
+                                if valueSets is not None:       # The coding systems for this component, if it is a coded component
+                                    componentCodingSystems = valueSets.get(f'{seg}-{i + 1:d}.{k + 1:d}')
+                                else:
+                                    componentCodingSystems = None
+                                numSubComponents = len(componentBits)
+                                for l, subComponent in enumerate(subComponents):
+                                    if subComponent == '""':
+                                        continue
+                                    if l < numSubComponents:
+                                        subCompAttrib = componentBits[l].attrib
+                                    else:
+                                        subCompAttrib = {}
+                                    if ('ref' in subCompAttrib) and ('minOccurs' in subCompAttrib):
+                                        subCompRef = subCompAttrib['ref']
+                                        thisMin = subCompAttrib['minOccurs']
+                                        if thisMin.isdigit():
+                                            subCompMin = int(thisMin)
                                         else:
-                                            subCompRef = None
                                             subCompMin = None
-                                            subComponentXML = et.Element(subCompCode)
-                                            subCompType = 'ST'
-                                            subCompTable = None
-                                        if subComponent == '':
-                                            if (subCompMin is not None) and (subCompMin > 0):
-                                                comment = f'Missing required subcomponent [{subCompCode}] in Segment {seg} at segment {segmentNo + 1:d}, field [{fieldCode}], repetition {j + 1:d}, subcomponent [{subCompCode}]'
-                                                print(comment, file=reportFile)
-                                                subComponentXML.append(et.Comment(comment))
-                                                componentXML.append(subComponentXML)
-                                            continue
-                                        if subCompRef is not None:
-                                            if subCompType is None:
-                                                comment = f'Undefined subcomponent in Segment {seg} at segment {segmentNo + 1:d}, field [{fieldCode}], repetition {j + 1:d}, subcomponent [{subCompCode}]'
-                                                print(comment, file=reportFile)
-                                                subComponentXML.append(et.Comment(comment))
-                                        else:
-                                            comment = f'Unexpected subcomponent in Segment {seg} at segment {segmentNo + 1:d}, field [{fieldCode}], repetition {j + 1:d}, subcomponent [{subCompCode}] - {subComponent}'
-                                            print(comment, file=reportFile)
-                                            subComponentXML.append(et.Comment(comment))
-                                        subComponentXML.text = subComponent
-                                        comment = fixElement(subComponentXML, subCompType, componentType, l + 1, componentXML)
-                                        if comment is not None:
-                                            comment += f' in Segment {seg} at segment {segmentNo + 1:d} in field [{fieldCode}], repetition {j+ 1:d}, subcomponent [{subCompCode}]'
-                                            print(comment, file=reportFile)
-                                            subComponentXML.append(et.Comment(comment))
-                                        if (subCompTable is not None) and (hl7Tables is not None) and (subCompTable in hl7Tables):
-                                            if subComponent not in hl7Tables[fieldTable]['codes']:
-                                                comment = f'Illegal value "{subComponent}" - not in {hl7Tables[subCompTable]['type']} table {subCompTable} in Segment {seg} at segment {segmentNo + 1:d}, field [{fieldCode}], repetition {j + 1:d}, subcomponent [{subCompCode}]'
-                                                print(comment, reportFile)
-                                                subComponentXML.append(et.Comment(comment))
-                                        if (datatypeLengths is not None) and (subCompType in datatypeLengths) and (l in datatypeLengths[subCompType]):
-                                            if len(subComponent) > datatypeLengths[subCompType][l]:
-                                                comment = f'Illegally long subcomponent - "{subComponent}" in Segment {seg} at segment {segmentNo + 1:d} in field [{fieldCode}], repetition {j + 1:d}, subComponent [{subCompCode}]'
-                                                print(comment, file=reportFile)
-                                                subComponentXML.append(et.Comment(comment))
-                                        if (valueSets is not None) and (l in [2, 5]) and (componentCode in valueSets) and (subComponent in valueSets[componentCode]):
-                                            if (subComponents[l -2] not in valueSets[componentCode][subComponent]):
-                                                comment = f'Identifier "{subComponents[l - 2]}" not in coding system "{subComponent}" in Segment {seg} at segment {segmentNo + 1:d}, field [{fieldCode}], repetition {j + 1:d}, component[{componentCode}]'
-                                                print(comment, file=reportFile)
-                                                subComponentXML.append(et.Comment(comment))
-                                        componentXML.append(subComponentXML)
-                                else:
-                                    componentXML.text = component
-                                    comment = fixElement(componentXML, componentType, fieldType, i + 1, fieldXML)
+                                        subComponentXML = et.Element(subCompRef)
+                                        subCompType, subCompTable = dataTypeAttributes.get(subCompRef, (None, None))
+                                    else:
+                                        subCompRef = None
+                                        subCompMin = None
+                                        subCompCode = f'{seg}-{i + 1:d}.{k + 1:d}.{l + 1:d}'
+                                        subComponentXML = et.Element(subCompCode)
+                                        subCompType = 'ST'
+                                        subCompTable = None
+                                    if subComponent == '':
+                                        if (subCompMin is not None) and (subCompMin > 0):
+                                            subCompCode = f'{seg}-{i + 1:d}.{k + 1:d}.{l + 1:d}'
+                                            comment = f'Missing required subcomponent [{subCompCode}] {inSegment}, field [{fieldCode}], repetition {j + 1:d}, subcomponent [{subCompCode}]'
+                                            reportError(subComponentXML, comment)
+                                            componentXML.append(subComponentXML)
+                                        continue
+                                    if subCompRef is not None:
+                                        if subCompType is None:
+                                            subCompCode = f'{seg}-{i + 1:d}.{k + 1:d}.{l + 1:d}'
+                                            comment = f'Undefined subcomponent {inSegment}, field [{fieldCode}], repetition {j + 1:d}, subcomponent [{subCompCode}]'
+                                            reportError(subComponentXML, comment)
+                                    else:
+                                        comment = f'Unexpected subcomponent {inSegment}, field [{fieldCode}], repetition {j + 1:d}, subcomponent [{subCompCode}] - {subComponent}'
+                                        reportError(subComponentXML, comment)
+                                    subComponentXML.text = subComponent
+                                    comment = fixElement(subComponentXML, subCompType, componentType, l + 1, subComponents)
                                     if comment is not None:
-                                        comment += f' in Segment {seg} at segment {segmentNo + 1:d} in field [{fieldCode}], repetition {k + 1:d}, component [{componentCode}]'
-                                        print(comment, file=reportFile)
-                                        componentXML.append(et.Comment(comment))
-                                    if (componentTable is not None) and (hl7Tables is not None) and (componentTable in hl7Tables):
-                                        if component not in hl7Tables[fieldTable]['codes']:
-                                            comment = f'Illegal value "{component}" - not in {hl7Tables[componentTable]['type']} table {componentTable} in Segment {seg} at segment {segmentNo + 1:d}, field [{fieldCode}], repetition {k + 1:d}, component [{componentCode}]'
-                                            print(comment, reportFile)
-                                            componentXML.append(et.Comment(comment))
-                                    if (datatypeLengths is not None) and (componentType in datatypeLengths) and (k in datatypeLengths[componentType]):
-                                        if len(component) > datatypeLengths[componentType][k]:
-                                            comment = f'Illegally long component - "{component}" in Segment {seg} at segment {segmentNo + 1:d} in field [{fieldCode}], repetition {j + 1:d}, component [{componentCode}]'
-                                            print(comment, file=reportFile)
-                                            componentXML.append(et.Comment(comment))
-                                    if (valueSets is not None) and (k in [2, 5]) and (fieldCode in valueSets) and (component in valueSets[fieldCode]):
-                                        if (Components[k -2] not in valueSets[componentCode][component]):
-                                            comment = f'Identifier "{Components[l - 2]}" not in coding system "{component}" in Segment {seg} at segment {segmentNo + 1:d}, field [{fieldCode}], repetition {j + 1:d}'
-                                            print(comment, file=reportFile)
-                                            componentXML.append(et.Comment(comment))
+                                        subCompCode = f'{seg}-{i + 1:d}.{k + 1:d}.{l + 1:d}'
+                                        comment += f' {inSegment} in field [{fieldCode}], repetition {j + 1:d}, subcomponent [{subCompCode}]'
+                                        reportError(subComponentXML, comment)
+                                    if (subCompTable is not None) and (hl7Tables is not None) and (subCompTable in hl7Tables):
+                                        if subComponent not in hl7Tables[subCompTable]['codes']:
+                                            subCompCode = f'{seg}-{i + 1:d}.{k + 1:d}.{l + 1:d}'
+                                            comment = f'Illegal value "{subComponent}" - not in {hl7Tables[subCompTable]["type"]} table {subCompTable} {inSegment}, field [{fieldCode}], repetition {j + 1:d}, subcomponent [{subCompCode}]'
+                                            reportError(subComponentXML, comment)
+                                    if (datatypeLengths is not None) and (subCompType in datatypeLengths) and (l in datatypeLengths[subCompType]):
+                                        if len(subComponent) > datatypeLengths[subCompType][l]:
+                                            subCompCode = f'{seg}-{i + 1:d}.{k + 1:d}.{l + 1:d}'
+                                            comment = f'Illegally long subcomponent - "{subComponent}" {inSegment} in field [{fieldCode}], repetition {j + 1:d}, subComponent [{subCompCode}]'
+                                            reportError(subComponentXML, comment)
+                                    if (componentCodingSystems is not None) and (l in (2, 5)) and (subComponent in componentCodingSystems):
+                                        if subComponents[l - 2] not in componentCodingSystems[subComponent]:
+                                            componentCode = f'{seg}-{i + 1:d}.{k + 1:d}'
+                                            comment = f'Identifier "{subComponents[l - 2]}" not in coding system "{subComponent}" {inSegment}, field [{fieldCode}], repetition {j + 1:d}, component[{componentCode}]'
+                                            reportError(subComponentXML, comment)
+                                    componentXML.append(subComponentXML)
                             else:
-                                comment = f'Unexpected component in Segment {seg} at segment {segmentNo + 1:d}, field {fieldCode}, repetition {k + 1:d} - {component}'
-                                print(comment, file=reportFile)
-                                fieldXML.append(et.Comment(comment))
                                 componentXML.text = component
-                                comment = fixElement(componentXML, componentType, fieldType, i + 1, fieldXML)
+                                comment = fixElement(componentXML, componentType, fieldType, k + 1, Components)
                                 if comment is not None:
-                                    comment += f' in Segment {seg} at segment {segmentNo + 1:d} in field [{fieldCode}], repetition {k + 1:d}, component [{componentCode}]'
-                                    print(comment, file=reportFile)
-                                    componentXML.append(et.Comment(comment))
-                        fieldXML.append(componentXML)
-                    else:
-                        fieldXML.text = thisField
+                                    componentCode = f'{seg}-{i + 1:d}.{k + 1:d}'
+                                    comment += f' {inSegment} in field [{fieldCode}], repetition {j + 1:d}, component [{componentCode}]'
+                                    reportError(componentXML, comment)
+                                if (componentTable is not None) and (hl7Tables is not None) and (componentTable in hl7Tables):
+                                    if component not in hl7Tables[componentTable]['codes']:
+                                        componentCode = f'{seg}-{i + 1:d}.{k + 1:d}'
+                                        comment = f'Illegal value "{component}" - not in {hl7Tables[componentTable]["type"]} table {componentTable} {inSegment}, field [{fieldCode}], repetition {j + 1:d}, component [{componentCode}]'
+                                        reportError(componentXML, comment)
+                                if (datatypeLengths is not None) and (componentType in datatypeLengths) and (k in datatypeLengths[componentType]):
+                                    if len(component) > datatypeLengths[componentType][k]:
+                                        componentCode = f'{seg}-{i + 1:d}.{k + 1:d}'
+                                        comment = f'Illegally long component - "{component}" {inSegment} in field [{fieldCode}], repetition {j + 1:d}, component [{componentCode}]'
+                                        reportError(componentXML, comment)
+                                if (fieldCodingSystems is not None) and (k in (2, 5)) and (component in fieldCodingSystems):
+                                    if Components[k - 2] not in fieldCodingSystems[component]:
+                                        comment = f'Identifier "{Components[k - 2]}" not in coding system "{component}" {inSegment}, field [{fieldCode}], repetition {j + 1:d}'
+                                        reportError(componentXML, comment)
+                        else:
+                            comment = f'Unexpected component {inSegment}, field {fieldCode}, repetition {j + 1:d} - {component}'
+                            reportError(fieldXML, comment)
+                            componentXML.text = component
+                            comment = fixElement(componentXML, componentType, fieldType, k + 1, Components)
+                            if comment is not None:
+                                comment += f' {inSegment} in field [{fieldCode}], repetition {j + 1:d}, component [{componentCode}]'
+                                reportError(componentXML, comment)
+                    fieldXML.append(componentXML)
+                else:
+                    fieldXML.text = thisField
+                    if thisField != '':         # An empty repetition has nothing to check
                         comment = fixElement(fieldXML, fieldType, None, None, None)
                         if comment is not None:
-                            comment += f' in Segment {seg} at segment {segmentNo + 1:d} in field [{fieldCode}], repetition {k + 1:d}'
-                            print(comment, file=reportFile)
-                            fieldXML.append(et.COmment(comment))
-                        if (fieldTable is not None) and (hl7Tables is not None) and (fieldTable in hl7Tables):
-                            if thisField not in hl7Tables[fieldTable]['codes']:
-                                comment = f'Illegal value "{thisField}" - not in {hl7Tables[fieldTable]['type']} table {fieldTable} in Segment {seg} at segment {segmentNo + 1:d}, field [{fieldCode}], repetition {k + 1:d}'
-                                print(comment, reportFile)
-                                fieldXML.append(et.Comment(comment))
-                        if (fieldLengths is not None) and (fieldCode in fieldLengths) and (fieldLengths[fieldCode] not in [999999, 65356]):
-                            if len(thisField) > fieldLengths[fieldCode]:
-                                comment = f'Illegally long field - "{thisField}" in Segment {seg} at segment {segmentNo + 1:d} in field [{fieldCode}], repetition {j + 1:d}'
-                                print(comment, file=reportFile)
-                                fieldXML.append(et.Comment(comment))
-                else:       # Undefined field
-                    comment = f'Unexpected field in Segment {seg} at {segmentNo + 1:d}, field {fieldCode} - {thisField}'
-                    print(comment, file=reportFile)
-                    fieldXML.append(et.Comment(comment))
-                    fieldXML.text = thisField
+                            comment += f' {inSegment} in field [{fieldCode}], repetition {j + 1:d}'
+                            reportError(fieldXML, comment)
+                    if (fieldTable is not None) and (hl7Tables is not None) and (fieldTable in hl7Tables):
+                        if thisField not in hl7Tables[fieldTable]['codes']:
+                            comment = f'Illegal value "{thisField}" - not in {hl7Tables[fieldTable]["type"]} table {fieldTable} {inSegment}, field [{fieldCode}], repetition {j + 1:d}'
+                            reportError(fieldXML, comment)
+                    if (fieldLengths is not None) and (fieldCode in fieldLengths) and (fieldLengths[fieldCode] not in [999999, 65356]):
+                        if len(thisField) > fieldLengths[fieldCode]:
+                            comment = f'Illegally long field - "{thisField}" {inSegment} in field [{fieldCode}], repetition {j + 1:d}'
+                            reportError(fieldXML, comment)
+            else:       # Undefined field
+                comment = f'Unexpected field in Segment {seg} at {segmentNo + 1:d}, field {fieldCode} - {thisField}'
+                reportError(fieldXML, comment)
+                fieldXML.text = thisField
+                if thisField != '':         # An empty repetition has nothing to check
                     comment = fixElement(fieldXML, fieldType, None, None, None)
                     if comment is not None:
-                        comment += f' in Segment {seg} at segment {segmentNo + 1:d} in field [{fieldCode}]'
-                        print(comment, file=reportFile)
-                        fieldXML.append(et.Comment(comment))
-                segElement.append(fieldXML)
-        thisElement.append(segElement)
-        segmentNo += 1
-        if segmentNo == len(Segments):
-            return thisElement
-        if isChoice:
-            return thisElement
-        occurs += 1
-        maxOccurs = sequenceList[sequenceAt].attrib['maxOccurs']
-        if maxOccurs == 'unbounded':
-            continue
-        if int(occurs) < int(maxOccurs):
-            continue
-        sequenceAt += 1
-        if sequenceAt < len(sequenceList):
-            continue
-    return thisElement
+                        comment += f' {inSegment} in field [{fieldCode}]'
+                        reportError(fieldXML, comment)
+            segElement.append(fieldXML)
 
 
-def fixElement(thisElement, textType, parentType, parentSequence, parentXML):
+def fixElement(thisElement, textType, parentType, parentSequence, parentBits):
     '''
     Fix the text associated with thisElement
     '''
@@ -537,72 +716,25 @@ def fixElement(thisElement, textType, parentType, parentSequence, parentXML):
         return None
 
     # Check some known patterns
-    if textType == 'DT':            # Check that this is a correctly formatted date
-        if DTpattern.search(elementText) is None:
-            return f'Illegally formated date "{elementText}"'
-        return None
-    if textType == 'DTM':           # Check that this is a correctly formatted date/time
-        if DTMpattern.search(elementText) is None:
-            return f'Illegally formatted date/time "{elementText}"'
-        return None
-    if (parentType == 'ED') and (parentSequence == 4):          # Check that this is correclty formatted encoding
-        if elementText not in ['Hex', 'Base64']:
-            return f'Illegal Encapsulated Data encoding "{elementText}"'
+    textCheck = textTypeChecks.get(textType)
+    if (textCheck is None) and (parentType is not None):
+        textCheck = parentTypeChecks.get((parentType, parentSequence))
+    if textCheck is not None:
+        isValid, message = textCheck
+        if not isValid(elementText):
+            return message.format(elementText)
         return None
     if (parentType == 'ED') and (parentSequence == 5):          # Check that this is correclty formatted Hex or Base64 encoded data
-        if parentXML is None:
-            return None
-        ED4 = parentXML.find("ED.4", namespaces)
-        if ED4 is None:
+        if (parentBits is None) or (len(parentBits) < 4):
             return None
-        encoding = ED4.text
-        if encoding is None:
+        encoding = parentBits[3]            # ED.4, straight from the split parent rather than from the XML
+        if encoding in ['', '""']:
             return None
         if encoding == 'Hex':
-            if ((len(elementText) % 2) != 0) or (Hexpattern.search(elementText) is None):
-                return f'Illegally formated Hex data'
-        elif ((len(elementText) % 4) != 0) or (Base64pattern.search(elementText) is None):
-            return f'Illegally formated Base64 encoded data'
-        return None       
-    if textType == 'NM':            # Check that this is a corractly formatted number
-        if NMpattern.search(elementText) is None:
-            return(f'Illegally formatted number "{elementText}"')
-        return None
-    if (parentType == 'RI') and (parentSequence == 2):          # Check that this is a correctly formatted time interval
-        if RI2pattern.search(elementText) is None:
-            return f'Illegally formatted time interval "{elementText}"'
-        return None
-    if textType == 'SI':            # Check that this is a correctly formatted sequence identifier
-        if SIpattern.search(elementText) is None:
-            return f'Illegally formatted sequence identifier "{elementText}"'
-        return None
-    if textType == 'SN.1':          # Check that this is a correctly formatted structure numeric comparitor
-        if elementText not in ['<', '>', '=', '<=', '>=', '<>']:
-            return f'Illegally formatted numeric comparitor "{elementText}"'
-        return None
-    if (parentType == 'SN') and (parentSequence == 3):          # Check that this is a correctly formatted numeric separator/suffix
-        if (len(elementText) > 1) or (elementText not in '+-/.:'):
-            return f'Illegally formatted numeric separator/suffix "{elementText}"'
-        return None
-    if textType == 'TM':            # Check that this is a correctly formatted time
-        if TMpattern.search(elementText) is None:
-            return f'Illegally formatted time "{elementText}"'
-        return None
-    if textType == 'TN':            # Check that this is a correctly formatted telephone number
-        if TNpattern.search(elementText) is None:
-            return 'Illegally formatted telephone number "{elementText}"'
-        return None
-    if (parentType == 'TS') and (parentSequence == 1):          # Check that this is a correctly formatted timestamp [DTM]
-        if DTMpattern.search(elementText) is None:
-            return f'Illegally formatted date/time "{elementText}"'
-        return None
-    if (parentType == 'TS') and (parentSequence == 2):          # Check that this is a correctly formatted time degree of precision
-        if TS2pattern.search(elementText) is None:
-            return f'Illegally formatted time degree of precission "{elementText}"'
-        return None
-    if (parentType == 'XTN') and (parentSequence == 1):         # Check that this is a correctly formatted telephone number [TN]
-        if TNpattern.search(elementText) is None:
-            return 'Illegally formatted telephone number "{elementText}"'
+            if ((len(elementText) % 2) != 0) or (Hexpattern.fullmatch(elementText) is None):
+                return 'Illegally formated Hex data'
+        elif ((len(elementText) % 4) != 0) or (Base64pattern.fullmatch(elementText) is None):
+            return 'Illegally formated Base64 encoded data'
         return None
 
     '''
@@ -612,184 +744,137 @@ def fixElement(thisElement, textType, parentType, parentSequence, parentXML):
     '''
     if textType not in ['TX', 'FT', 'CF']:
         return None
-    while (charRef := charXref.search(elementText)) is not None:
-        chars = charRef.group()[2:-1]
-        repChars = ''
-        for cp in range(0, len(chars), 2):
-            repChars += r'&#x' + chars[cp:cp + 2] + ';'
-        elementText = elementText[0:charRef.start()] + repChars + elementText[charRef.end():]
-    while (charRef := charZref.search(elementText)) is not None:
-        chars = charRef.group()[2:-1]
-        repChars = ''
-        for cp in range(0, len(chars), 2):
-            repChars += r'&#x' + chars[cp:cp + 2] + ';'
-        elementText = elementText[0:charRef.start()] + repChars + elementText[charRef.end():]
-    thisElement.text = elementText
-    firstEscape = None
-    for replacement in xmlReplacements:
-        if (found := replacement.search(elementText)) is not None:
-            if (firstEscape is None) or (found.start() < firstEscape):
-                firstEscape = found.start()
-                firstEnd = found.end()
-                firstGroup = found.group()
-    if firstEscape is None:
+    escapeElement = None
+    textBits = []
+    textAt = 0
+    for escape in hl7Escapes.finditer(elementText):         # One pass for both hex data and formatting escape sequences
+        textBits.append(elementText[textAt:escape.start()])
+        textAt = escape.end()
+        chars = escape.group('hex')
+        if chars is not None:           # \Xhh..\ or \Zhh..\ - replace with character references
+            textBits.append(hexPair.sub(r'&#x\g<0>;', chars))
+            continue
+        if escapeElement is None:
+            thisElement.text = ''.join(textBits)
+        else:
+            escapeElement.tail = ''.join(textBits)
+        textBits = []
+        escapeElement = et.SubElement(thisElement, 'escape', V=escape.group('format'))
+    if textAt == 0:         # No escape sequences
         return None
-    thisElement.text = elementText[:firstEscape]
-    escapeElement = et.Element('escape')
-    escapeElement.attrib['V'] = firstGroup[1:-1]
-    escapeElement.tail = elementText[firstEnd:]
-    thisElement.append(escapeElement)
-    lastEscapeElement = escapeElement
-    escapeElementTail = escapeElement.tail
-    while True:
-        nextEscape = None
-        for replacement in xmlReplacements:
-            if (found := replacement.search(escapeElementTail)) is not None:
-                if (nextEscape is None) or (found.start() < nextEscape):
-                    nextEscape = found.start()
-                    nextEnd = found.end()
-                    nextGroup = found.group()
-        if nextEscape is None:
-            return None
-        lastEscapeElement.tail = escapeElementTail[:nextEscape]
-        escapeElement = et.Element('escape')
-        escapeElement.attrib['V'] = nextGroup[1:-1]
-        escapeElement.tail = escapeElementTail[nextEnd:]
-        thisElement.append(escapeElement)
-        lastEscapeElement = escapeElement
-        escapeElementTail = escapeElement.tail
+    textBits.append(elementText[textAt:])
+    if escapeElement is None:
+        thisElement.text = ''.join(textBits)
+    else:
+        escapeElement.tail = ''.join(textBits)
     return None
 
 
-if __name__ == '__main__':
+def loadSchema(thisSchemaDir):
     '''
-    The main code
-    Start by parsing the command line arguements and setting up logging.
-    Then process each file name in the command line - read the HL7 v2.x vertical bar message
-    and convert it an HL7 v2.xml XML tagged message
+    Read in the segment, field, data type and message structure definitions, and any tables, from the schema folder
+    PARAMETERS:
+        thisSchemaDir - str, the folder containing the HL7 v2.xml XML Schema files and tables
     '''
 
-    # Set the command line options
-    progName = sys.argv[0]
-    progName = progName[0:-3]        # Strip off the .py ending
-    parser = argparse.ArgumentParser(description='hl7Validator')
-    parser.add_argument('-I', '--inputDir', dest='inputDir',
-                        help='The folder containing the HL7 v2.x vertical bar encoded message files')
-    parser.add_argument('-i', '--inputFile', dest='inputFile',
-                        help='The name of the HL7 v2.x vertical bar encoded message file')
-    parser.add_argument ('-R', '--reportDir', dest='reportDir', default='.', metavar='reportDir',
-                         help='The name of the directory where the report(s) file will be created')
-    parser.add_argument('-O', '--outputDir', dest='outputDir', default='.',
-                        help='The folder where the HL7 v2.xml XML tagged message(s) will be created (default=".")')
-    parser.add_argument('-S', '--schemaDir', dest='schemaDir', required=True, default='schema/v2.4',
-                        help='The folder containing the HL7 v2.xml XML schema files (default="schema/v2.4")')
-    parser.add_argument ('-v', '--verbose', dest='verbose', type=int, choices=range(0,5),
-                         help='The level of logging\n\t0=CRITICAL,1=ERROR,2=WARNING,3=INFO,4=DEBUG')
-    parser.add_argument ('-L', '--logDir', dest='logDir', default='.', metavar='logDir',
-                         help='The name of the directory where the logging file will be created')
-    parser.add_argument ('-l', '--logFile', dest='logFile', metavar='logfile', help='The name of a logging file')
-
-    # Parse the command line
-    args = parser.parse_args()
-    inputDir = args.inputDir
-    inputFile = args.inputFile
-    reportDir = args.reportDir
-    outputDir = args.outputDir
-    schemaDir = args.schemaDir
-    logDir = args.logDir
-    logFile = args.logFile
-    loggingLevel = args.verbose
-
-    # Set up logging
-    logging_levels = {0:logging.CRITICAL, 1:logging.ERROR, 2:logging.WARNING, 3:logging.INFO, 4:logging.DEBUG}
-    logfmt = progName + ' [%(asctime)s]: %(message)s'
-    if loggingLevel is not None:    # Change the logging level from "WARN" if the -v vebose option is specified
-        if logFile is not None:        # and send it to a file if the -o logfile option is specified
-            with open(os.path.join(logDir, logFile), 'wt', encoding='utf-8', newline='') as logOutput:
-                pass
-            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', level=logging_levels[loggingLevel], filename=os.path.join(logDir, logFile))
-        else:
-            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', level=logging_levels[loggingLevel])
-    else:
-        if logFile is not None:        # send the default (WARN) logging to a file if the -o logfile option is specified
-            with open(os.path.join(logDir, logFile), 'wt', encoding='utf-8', newline='') as logOutput:
-                pass
-            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', filename=os.path.join(logDir, logFile))
-        else:
-            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p')
-    logging.debug('Logging set up')
+    global schemaDir, xsdDir, segmentRoot, fieldRoot, dataTypeRoot, namespaces
+    global segmentSequences, fieldAttributes, dataTypeSequences, dataTypeAttributes
 
+    schemaDir = thisSchemaDir
     # Check that the schemaDir folder exist and read in the segment, fields and datatype schema
     if not os.path.isdir(schemaDir):
         logging.critical('No schemaDir folder named "%s"', schemaDir)
         logging.shutdown()
         sys.exit(EX_CONFIG)
-    if not os.path.isdir(os.path.join(schemaDir, 'xsd')):
+    xsdDir = os.path.join(schemaDir, 'xsd')
+    if not os.path.isdir(xsdDir):
         logging.critical('No schemaDir folder named "%s/xsd"', schemaDir)
         logging.shutdown()
         sys.exit(EX_CONFIG)
-    if not os.path.isfile(os.path.join(schemaDir, 'xsd', 'segments.xsd')):
+    try:
+        segmentTree = et.parse(os.path.join(xsdDir, 'segments.xsd'))
+    except OSError:
         logging.critical('No file "segments.xsd" in schemaDir folder(%s/xsd)', schemaDir)
         logging.shutdown()
         sys.exit(EX_CONFIG)
-    segmentTree = et.parse(os.path.join(schemaDir, 'xsd', 'segments.xsd'))
     segmentRoot = segmentTree.getroot()
-    if not os.path.isfile(os.path.join(schemaDir, 'xsd', 'fields.xsd')):
+    try:
+        fieldTree = et.parse(os.path.join(xsdDir, 'fields.xsd'))
+    except OSError:
         logging.critical('No file "fields.xsd" in schemaDir folder(%s/xsd)', schemaDir)
         logging.shutdown()
         sys.exit(EX_CONFIG)
-    fieldTree = et.parse(os.path.join(schemaDir, 'xsd', 'fields.xsd'))
     fieldRoot = fieldTree.getroot()
-    if not os.path.isfile(os.path.join(schemaDir, 'xsd', 'datatypes.xsd')):
+    try:
+        dataTypeTree = et.parse(os.path.join(xsdDir, 'datatypes.xsd'))
+    except OSError:
         logging.critical('No file "datatypes.xsd" in schemaDir folder(%s/xsd)', schemaDir)
         logging.shutdown()
         sys.exit(EX_CONFIG)
-    dataTypeTree = et.parse(os.path.join(schemaDir, 'xsd', 'datatypes.xsd'))
     dataTypeRoot = dataTypeTree.getroot()
     namespaces={'xsd':'http://www.w3.org/2001/XMLSchema'}
 
+    # Index the segment, field and data type definitions so that validation doesn't have to search the XML Schemas
+    segmentSequences = getSequences(segmentRoot, '.CONTENT')
+    fieldAttributes = getAttributes(fieldRoot)
+    dataTypeSequences = getSequences(dataTypeRoot, '')
+    dataTypeAttributes = getAttributes(dataTypeRoot)
+
     # Check that the message structures file exists
     if not os.path.isfile(os.path.join(schemaDir, 'hl7Table0354.csv')):
         logging.critical('No file "hl7Table054.csv" in schemaDir folder(%s/xsd)', schemaDir)
         logging.shutdown()
         sys.exit(EX_CONFIG)
+
+    # Use the tables cache file, unless any table file has been added, removed or changed since it was saved
+    tableTimes = {}
+    for tableFile in tableFiles:
+        if os.path.isfile(os.path.join(schemaDir, tableFile)):
+            tableStat = os.stat(os.path.join(schemaDir, tableFile))
+            tableTimes[tableFile] = (tableStat.st_mtime_ns, tableStat.st_size)
+    if not loadTablesCache(tableTimes):
+        loadTables()
+        saveTablesCache(tableTimes)
+
+
+def loadTables():
+    '''
+    Read in the message structures, HL7 and User tables, field lengths, data type lengths and value sets from the schema folder
+    '''
+
+    global hl7messageStructures, hl7Tables, fieldLengths, datatypeLengths, valueSets
+
     hl7messageStructures = {}
     with open(os.path.join(schemaDir, 'hl7Table0354.csv'), 'rt', encoding='utf-8') as hl7TableFile:
         csvReader = csv.reader(hl7TableFile, delimiter='\t')
-        header = True
+        next(csvReader, None)       # Skip the header row
         for row in csvReader:
-            if header:
-                header = False
-                continue
             msgStructure = row[0]
             msgStruct = msgStructure[0:3]
             if msgStruct not in hl7messageStructures:
                 hl7messageStructures[msgStruct] = {}
+            msgStructTriggers = hl7messageStructures[msgStruct]
             msgTriggers = row[1].split(',')
             for trigger in msgTriggers:
                 thisTrigger = trigger.strip()
                 if len(thisTrigger) == 3:
-                    hl7messageStructures[msgStruct][thisTrigger] = msgStructure
-                elif (len(thisTrigger) == 7) and (thisTrigger[3:4] == '-'):
+                    msgStructTriggers[thisTrigger] = msgStructure
+                elif (len(thisTrigger) == 7) and (thisTrigger[3:4] == '-'):      # A range of trigger events, e.g. A01-A99
                     thisLetter = thisTrigger[0:1]
                     thisStart = int(thisTrigger[1:3])
                     thisEnd = int(thisTrigger[5:7]) + 1
-                    for eachTrigger in range(thisStart, thisEnd):
-                        oneTrigger = f'{thisLetter}{eachTrigger:02d}'
-                        hl7messageStructures[msgStruct][oneTrigger] = msgStructure
+                    msgStructTriggers.update(dict.fromkeys([thisLetter + eachNumber for eachNumber in triggerNumbers[thisStart:thisEnd]], msgStructure))
 
     # Check that HL7 and User tables file exists
     if os.path.isfile(os.path.join(schemaDir, 'hl7Tables.csv')):
         hl7Tables = {}
         with open(os.path.join(schemaDir, 'hl7Tables.csv'), 'rt', encoding='utf-8') as hl7TableFile:
             csvReader = csv.reader(hl7TableFile, delimiter='\t')
-            header = True
+            next(csvReader, None)       # Skip the header row
             tableType = None
             tableNumber = None
+            tableCodes = None
             for row in csvReader:
-                if header:
-                    header = False
-                    continue
                 if (len(row) > 0) and (row[0] != ''):
                     tableType = row[0]
                 if (len(row) > 1) and (row[1] != ''):
@@ -799,9 +884,8 @@ if __name__ == '__main__':
                             logging.critical('Error in hl7Tables.csv file - table [%s] without table type', tableNumber)
                             logging.shutdown()
                             sys.exit(EX_CONFIG)
-                        hl7Tables[tableNumber] = {}
-                        hl7Tables[tableNumber]['type'] = tableType
-                        hl7Tables[tableNumber]['codes'] = []
+                        hl7Tables[tableNumber] = {'type': tableType, 'codes': set()}
+                    tableCodes = hl7Tables[tableNumber]['codes']
                 if len(row) < 4:
                     continue
                 tableCode = row[3]
@@ -811,18 +895,18 @@ if __name__ == '__main__':
                     logging.critical('Error in hl7Tables.csv file - table code [%s] without table number', tableCode)
                     logging.shutdown()
                     sys.exit(EX_CONFIG)
-                hl7Tables[tableNumber]['codes'].append(tableCode)
+                tableCodes.add(tableCode)
+        # Freeze the codes in each table
+        for tableNumber in hl7Tables:
+            hl7Tables[tableNumber]['codes'] = frozenset(hl7Tables[tableNumber]['codes'])
 
     # Check if field length file exits
     if os.path.isfile(os.path.join(schemaDir, 'hl7Fields.csv')):
         fieldLengths = {}
         with open(os.path.join(schemaDir, 'hl7Fields.csv'), 'rt', encoding='utf-8') as hl7FieldsFile:
             csvReader = csv.reader(hl7FieldsFile, delimiter='\t')
-            header = True
+            next(csvReader, None)       # Skip the header row
             for row in csvReader:
-                if header:
-                    header = False
-                    continue
                 if len(row) < 3:
                     logging.critical('Error in hl7Fields.csv - too few columns')
                     logging.shutdown()
@@ -842,18 +926,15 @@ if __name__ == '__main__':
                     logging.critical('Error in hl7Fields.csv - too many columns - "%s"', str(row))
                     logging.shutdown()
                     sys.exit(EX_CONFIG)
-    
+
     # Check if the datatype lengths file exists
     if os.path.isfile(os.path.join(schemaDir, 'hl7DataTypes.csv')):
         datatypeLengths = {}
         with open(os.path.join(schemaDir, 'hl7DataTypes.csv'), 'rt', encoding='utf-8') as hl7DataTypesFile:
             csvReader = csv.reader(hl7DataTypesFile, delimiter='\t')
-            header = True
+            next(csvReader, None)       # Skip the header row
             dataType = None
             for row in csvReader:
-                if header:
-                    header = False
-                    continue
                 if len(row) < 1:
                     continue
                 elif len(row) == 1:
@@ -864,13 +945,13 @@ if __name__ == '__main__':
                 elif len(row) == 2:
                     try:
                         seq = int(row[0]) - 1
-                        length = int[row[1]]
+                        length = int(row[1])
                     except:
                         logging.critical('Error in hl7DataTypes.csv - invalid sequence [%s] or length [%s]', row[0], row[1])
                         logging.shutdown()
                         sys.exit(EX_CONFIG)
                     if dataType is None:
-                        logging.critial('Error in hl7DataTypes.csv - missing dataType at start of file')
+                        logging.critical('Error in hl7DataTypes.csv - missing dataType at start of file')
                         logging.shutdown()
                         sys.exit(EX_CONFIG)
                     datatypeLengths[dataType][seq] = length
@@ -884,13 +965,10 @@ if __name__ == '__main__':
         valueSets = {}
         with open(os.path.join(schemaDir, 'valueSets.csv'), 'rt', encoding='utf-8') as valueSetsFile:
             csvReader = csv.reader(valueSetsFile, delimiter='\t')
-            header = True
+            next(csvReader, None)       # Skip the header row
             fieldOrComponent = None
             codingSystem = None
             for row in csvReader:
-                if header:
-                    header = False
-                    continue
                 if len(row) < 1:
                     continue
                 if len(row) == 1:
@@ -917,158 +995,186 @@ if __name__ == '__main__':
                     if fieldOrComponent not in valueSets:
                         valueSets[fieldOrComponent] = {}
                     if codingSystem not in valueSets[fieldOrComponent]:
-                        valueSets[fieldOrComponent][codingSystem] = []
-                    valueSets[fieldOrComponent][codingSystem].append(identifier)
+                        valueSets[fieldOrComponent][codingSystem] = set()
+                    valueSets[fieldOrComponent][codingSystem].add(identifier)
                 else:
                     logging.critical('Error in valueSets.csv - too many columns - "%s"', str(row))
                     logging.shutdown()
                     sys.exit(EX_CONFIG)
-                    
-    # If inputFile is specified and is '-', then read one HL7 v2.x vertical bar encoded message from standard input
-    # If inputFile is specified and is not '-', and inputDir is None then read one HL7 v2.x vertical bar encoded message from ./inputFile.
-    # If inputFile is specified and is not '-', and inputDir is not None then read one HL7 v2.x vertical bar encoded message from inputDir/inputFile.
-    # If both inputFile and inputDir are not specified, then read one HL7 v2.x vertical bar encoded message from standard input.
-    # If inputFile is not specified, but inputDir is specified, then read one HL7 v2.x vertical bar encoded message for every file in inputDir.
+        # Freeze the identifiers in each coding system
+        for fieldOrComponent in valueSets:
+            for codingSystem in valueSets[fieldOrComponent]:
+                valueSets[fieldOrComponent][codingSystem] = frozenset(valueSets[fieldOrComponent][codingSystem])
 
-    # If one HL7 v2.x vertical bar encoded message is read from standard input, then output the report to stdout.
-    # Otherwise use the basename of filename, with the extension changed to '.rpt' to create the reportFile filename.
-    # If reportDir is specified, then create the file as reportDir/reportFile.rpt
-    # If reportDir is not specified, then create the file as inputDir/reportFile.rpt
-    hl7MessageFiles = []
-    if inputFile is not None:
-        if inputFile == '-':
-            hl7MessageFiles.append('-')
-        elif inputDir is None:
-            hl7MessageFiles.append(inputFile)
-        else:
-            hl7MessageFiles.append(os.path.join(inputDir, inputFile))
-    else:
-        if inputDir is None:
-            hl7MessageFiles.append('-')
-        else:
-            for thisFile in os.listdir(inputDir):
-                hl7MessageFiles.append(os.path.join(inputDir, thisFile))
 
-    # Process each of these HL7 v2.x vertical bar encoded messages
-    for messageFile in hl7MessageFiles:
-        # Open the reports file
-        if messageFile == '-':
-            reportFile = sys.stdout
-        else:
-            basename = os.path.basename(messageFile)
-            name, ext = os.path.splitext(basename)
-            reportFilename = name + '.rpt'
-            if reportDir is not None:
-                reportName = os.path.join(reportDir, reportFilename)
-            elif inputDir is not None:
-                reportName = os.path.join(inputDir, reportFilename)
-            if reportName == messageFile:
-                reportName = 'report_' + reportFile
-            try:
-                reportFile = open(reportName, 'wt', encoding='utf-8', newline='')
-            except:
-                logging.fatal('Cannot create report file - %s', reportFilename)
-                logging.shutdown()
-                sys.exit(EX_CANTCREAT)
+def loadTablesCache(tableTimes):
+    '''
+    Load the tables from the tables cache file, if it was created from the current table files
+    PARAMETERS:
+        tableTimes - dict, the modification time and size of each table file in the schema folder
+    RETURNS:
+        bool, True if the tables were loaded from the tables cache file
+    '''
 
-        # Get the vertical bar message
-        hl7Message = getDocument(messageFile)
+    global hl7messageStructures, hl7Tables, fieldLengths, datatypeLengths, valueSets
 
-        # Check for MLLP
-        if (hl7Message[0:1] == chr(11)) and (hl7Message[-2:] == chr(28) + chr(13)):
-            hl7Message = hl7Message[1:-2]
+    try:
+        with open(os.path.join(schemaDir, tablesCacheFile), 'rb') as cacheFile:
+            cachedTimes, cachedTables = pickle.load(cacheFile)
+        if cachedTimes != tableTimes:
+            return False
+        cachedStructures, cachedHl7Tables, cachedFieldLengths, cachedDatatypeLengths, cachedValueSets = cachedTables
+    except Exception:       # A missing, unreadable or out of date format cache file is rebuilt
+        return False
+    hl7messageStructures = cachedStructures
+    hl7Tables = cachedHl7Tables
+    fieldLengths = cachedFieldLengths
+    datatypeLengths = cachedDatatypeLengths
+    valueSets = cachedValueSets
+    return True
 
-        # Convert this hl7 v2.x vertical bar encoded message
-        Segments = hl7Message.rstrip().split('\r')
 
-        # Check that the MSH can at least be partially parsed
-        MSH = Segments[0]
-        if len(MSH) < 20:
-            logging.fatal('First segment too short - less than 20 characters')
-            logging.shutdown()
-            sys.exit(EX_DATAERR)
-        if MSH[0:3] != 'MSH':
-            logging.fatal('First segment not MSH')
-            logging.shutdown()
-            sys.exit(EX_DATAERR)
+def saveTablesCache(tableTimes):
+    '''
+    Save the tables to the tables cache file, so that the next run doesn't have to read the table files
+    PARAMETERS:
+        tableTimes - dict, the modification time and size of each table file in the schema folder
+    '''
+
+    cacheName = os.path.join(schemaDir, tablesCacheFile)
+    tempName = f'{cacheName}.{os.getpid():d}'
+    cachedTables = (hl7messageStructures, hl7Tables, fieldLengths, datatypeLengths, valueSets)
+    try:
+        with open(tempName, 'wb') as cacheFile:
+            pickle.dump((tableTimes, cachedTables), cacheFile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tempName, cacheName)         # Other validators only ever see a complete cache file
+    except OSError as e:
+        logging.info('Cannot save the tables cache file (%s) - %s', cacheName, repr(e))
+        try:
+            os.remove(tempName)
+        except OSError:
+            pass
 
-        # Now partially parse the first segment (should be MSH)
-        # for the field separator and encoding characters
-        fieldSep = MSH[3:4]
-        MSHfields = MSH.split(fieldSep)
-        if len(MSHfields[1]) < 4:
-            subCompSep = ''
-        else:
-            subCompSep = MSHfields[1][3:4]
-        if len(MSHfields[1]) < 3:
-            escChar = ''
-            subCompSep = ''
-        else:
-            escChar = MSHfields[1][2:3]
-            subCompSep = MSHfields[1][3:4]
-        if len(MSHfields[1]) < 2:
-            logging.fatal('MSH.2 field less then 2 characters long')
-            logging.shutdown()
-            sys.exit(EX_DATAERR)
-        compSep = MSHfields[1][0:1]
-        repSep = MSHfields[1][1:2]
 
-        # And check that MSH has enough fields
-        if len(MSHfields) < 12:
-            logging.fatal('MSH segment too short - no version!')
+def validateFile(messageFile):
+    '''
+    Validate one HL7 v2.x vertical bar encoded message, creating the report file and the HL7 v2.xml XML message
+    PARAMETERS:
+        messageFile - str, the HL7 v2.x vertical bar encoded message file ('-' for standard input)
+    '''
+
+    global reportFile, Segments, segmentNo, fieldSep, repSep, compSep, subCompSep
+    global msgStruct, messageGroups, validationErrors
+
+    # Open the reports file
+    if messageFile == '-':
+        reportFile = sys.stdout
+    else:
+        basename = os.path.basename(messageFile)
+        name, ext = os.path.splitext(basename)
+        reportFilename = name + '.rpt'
+        if reportDir is not None:
+            reportName = os.path.join(reportDir, reportFilename)
+        elif inputDir is not None:
+            reportName = os.path.join(inputDir, reportFilename)
+        if reportName == messageFile:
+            reportName = os.path.join(os.path.dirname(reportName), 'report_' + reportFilename)
+        try:
+            reportFile = open(reportName, 'wt', encoding='utf-8', newline='')
+        except:
+            logging.fatal('Cannot create report file - %s', reportFilename)
             logging.shutdown()
-            sys.exit(EX_DATAERR)
+            sys.exit(EX_CANTCREAT)
+
+    # Get the vertical bar message
+    hl7Message = getDocument(messageFile)
+
+    # Convert this hl7 v2.x vertical bar encoded message
+    Segments = hl7Message.rstrip().split('\r')
 
-        # Now we can further parse the MSH segment for the message type, event and structure
-        # All we really want is structure (msgStruct)
-        struct = MSHfields[8]
-        msgStruct = ''
-        if struct == '' :
-            logging.fatal('Missing MSH.9.1 component [Message Code]')
+    # Check that the MSH can at least be partially parsed
+    MSH = Segments[0]
+    if len(MSH) < 20:
+        logging.fatal('First segment too short - less than 20 characters')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+    if MSH[0:3] != 'MSH':
+        logging.fatal('First segment not MSH')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+
+    # Now partially parse the first segment (should be MSH)
+    # for the field separator and encoding characters
+    fieldSep = MSH[3:4]
+    MSHfields = MSH.split(fieldSep)
+    encodingChars = MSHfields[1]
+    if len(encodingChars) < 2:
+        logging.fatal('MSH.2 field less then 2 characters long')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+    compSep = encodingChars[0:1]
+    repSep = encodingChars[1:2]
+    subCompSep = encodingChars[3:4]         # '' if there is no subcomponent separator
+
+    # And check that MSH has enough fields
+    if len(MSHfields) < 12:
+        logging.fatal('MSH segment too short - no version!')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+
+    # Now we can further parse the MSH segment for the message type, event and structure
+    # All we really want is structure (msgStruct)
+    struct = MSHfields[8]
+    msgStruct = ''
+    if struct == '' :
+        logging.fatal('Missing MSH.9.1 component [Message Code]')
+        logging.shutdown()
+        sys.exit(EX_DATAERR)
+    if struct == 'ACK':         # |ACK| is legal?
+        msgStruct = 'ACK'
+    else:
+        typeParts = struct.split(compSep)
+        if len(typeParts) == 1:     # |TYP| is illegal if TYP is not ACK
+            logging.critical('Missing MSH.9.2 component [Trigger Event] and MSH.9.3 component [Message Structure]')
             logging.shutdown()
             sys.exit(EX_DATAERR)
-        if struct == 'ACK':         # |ACK| is legal?
-            msgStruct = 'ACK'
-        else:
-            typeParts = struct.split(compSep)
-            if len(typeParts) == 1:     # |TYP| is illegal if TYP is not ACK
-                logging.critical('Missing MSH.9.2 component [Trigger Event] and MSH.9.3 component [Message Structure]')
+        msgType = typeParts[0]
+        msgTrigger = typeParts[1]
+        if len(typeParts) == 3:
+            msgStruct = typeParts[2]
+        if msgStruct == '':           # We don't have structure, so we will have to deduce it
+            if msgType == '':           # |^TRG| and |^TRG^| are illegal
+                logging.critical('Missing MSH.9.1 component [Message Type]')
                 logging.shutdown()
                 sys.exit(EX_DATAERR)
-            msgType = typeParts[0]
-            msgTrigger = typeParts[1]
-            if len(typeParts) == 3:
-                msgStruct = typeParts[2]
-            if msgStruct == '':           # We don't have structure, so we will have to deduce it
-                if msgType == '':           # |^TRG| and |^TRG^| are illegal
-                    logging.critical('Missing MSH.9.1 component [Message Type]')
+            if msgTrigger == '':
+                if msgType == 'ACK':        # |ACK^| and |ACK^^| are legal?
+                    msgStruct = 'ACK'
+                else:               # |TYP^| and |TYP^^| are illegal
+                    logging.critical('Missing MSH.9.2 component [Trigger Event] and MSH.9.3 component [Message Structure]')
                     logging.shutdown()
                     sys.exit(EX_DATAERR)
-                if msgTrigger == '':
-                    if msgType == 'ACK':        # |ACK^| and |ACK^^| are legal?
-                        msgStruct = 'ACK'
-                    else:               # |TYP^| and |TYP^^| are illegal
-                        logging.critical('Missing MSH.9.2 component [Trigger Event] and MSH.9.3 component [Message Structure]')
-                        logging.shutdown()
-                        sys.exit(EX_DATAERR)
-                else:       # Try and deduce message structure from type and trigger
-                    print(hl7messageStructures)
-                    if msgType not in hl7messageStructures:
-                        logging.critical('Unknown MSH.9.1 [Message Type] (%s)', msgType)
-                        logging.shutdown()
-                        sys.exit(EX_DATAERR)
-                    if msgTrigger not in hl7messageStructures[msgType]:
-                        logging.critical('Unknown MSH.9.2 [Message Trigger] (%s)', msgTrigger)
-                        logging.shutdown()
-                        sys.exit(EX_DATAERR)
-                    msgStruct = hl7messageStructures[msgType][msgTrigger]
+            else:       # Try and deduce message structure from type and trigger
+                if msgType not in hl7messageStructures:
+                    logging.critical('Unknown MSH.9.1 [Message Type] (%s)', msgType)
+                    logging.shutdown()
+                    sys.exit(EX_DATAERR)
+                if msgTrigger not in hl7messageStructures[msgType]:
+                    logging.critical('Unknown MSH.9.2 [Message Trigger] (%s)', msgTrigger)
+                    logging.shutdown()
+                    sys.exit(EX_DATAERR)
+                msgStruct = hl7messageStructures[msgType][msgTrigger]
 
-        # Now we need to read in the message structure as defined in the xsd
-        if not os.path.isfile(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd')):
+    # Now we need to read in the message structure as defined in the xsd (unless already read for an earlier message)
+    if msgStruct in messageSchemas:
+        segmentList, messageGroups = messageSchemas[msgStruct]
+    else:
+        try:
+            messageTree = et.parse(os.path.join(xsdDir, msgStruct + '.xsd'))
+        except (OSError, ValueError):       # ValueError if the message structure contains a null character
             logging.critical('Unknown message structure (%s)', msgStruct)
             logging.shutdown()
             sys.exit(EX_DATAERR)
-        messageTree = et.parse(os.path.join(schemaDir, 'xsd', msgStruct + '.xsd'))
         messageRoot = messageTree.getroot()
         segmentList = messageRoot.find("xsd:complexType[@name='" + msgStruct + ".CONTENT']/xsd:sequence", namespaces)
 
@@ -1077,28 +1183,179 @@ if __name__ == '__main__':
             logging.critical('MSH not defined for messages structure(%s)', msgStruct)
             logging.shutdown()
             sys.exit(EX_CONFIG)
+        messageGroups = getGroups(messageRoot)
+        messageSchemas[msgStruct] = (segmentList, messageGroups)
 
-        # Now validate the HL7 v2.x vertical bar message
-        segmentNo = 0
-        hl7XML = validateXML(segmentList, msgStruct, False, False, 0)
-
-        # Save the HL7 V2.xml message
-        hl7XML.attrib['xmlns'] = 'urn:hl7-org:v2xml'
-        hl7XML.attrib['xmlns:xsi'] = 'http://www.w3.org/2001/XMLSchema-instance'
-        hl7XML.attrib['xsi:schemaLocation'] = 'urn:hl7-org:v2xml ' + msgStruct + '.xsd'
-        et.indent(hl7XML, '    ')
-        s = et.tostring(hl7XML, encoding='unicode')
-        s = hl7charRef.sub(r'&\1', s)
-        if messageFile == '-':
-            print(s)
+    # Now validate the HL7 v2.x vertical bar message
+    segmentNo = 0
+    validationErrors = []
+    try:
+        hl7XML = validateXML(segmentList, msgStruct)
+    finally:        # Output the report, even if validation stopped on a fatal error in the XML Schemas
+        if validationErrors:
+            print('\n'.join(validationErrors), file=reportFile)
+        if reportFile is not sys.stdout:
+            reportFile.close()
+
+    # Save the HL7 V2.xml message
+    hl7XML.attrib['xmlns'] = 'urn:hl7-org:v2xml'
+    hl7XML.attrib['xmlns:xsi'] = 'http://www.w3.org/2001/XMLSchema-instance'
+    hl7XML.attrib['xsi:schemaLocation'] = 'urn:hl7-org:v2xml ' + msgStruct + '.xsd'
+    et.indent(hl7XML, '    ')
+    s = et.tostring(hl7XML, encoding='unicode')
+    s = hl7charRef.sub(r'&\1', s)
+    if messageFile == '-':
+        print(s)
+    else:
+        logging.info(s)
+        basename = os.path.basename(messageFile)
+        name, ext = os.path.splitext(basename)
+        outputFile = name + '.xml'
+        if outputDir is not None:
+            outputFile = os.path.join(outputDir, outputFile)
+        elif outputFile == messageFile:
+            outputFile = 'XML_' + outputFile
+        with open(outputFile, 'wt', encoding='utf-8', newline='') as fpout:
+            print(s, file=fpout)
+
+
+def initWorker(logConfig, thisSchemaDir, thisInputDir, thisReportDir, thisOutputDir, thisInlineErrors):
+    '''
+    Set up a worker process for validating messages in parallel
+    PARAMETERS:
+        logConfig - dict, the arguments for logging.basicConfig()
+        thisSchemaDir - str, the folder containing the HL7 v2.xml XML Schema files and tables
+        thisInputDir - str, the folder containing the HL7 v2.x vertical bar encoded message files
+        thisReportDir - str, the folder where the report files will be created
+        thisOutputDir - str, the folder where the HL7 v2.xml XML messages will be created
+        thisInlineErrors - boolean, whether validation errors are also added to the HL7 v2.xml XML messages as comments
+    A forked worker inherits the logging set up, schema and tables from the main process, but a spawned worker has to load them again
+    '''
+
+    global inputDir, reportDir, outputDir, inlineErrors
+
+    logging.basicConfig(**logConfig)
+    inputDir = thisInputDir
+    reportDir = thisReportDir
+    outputDir = thisOutputDir
+    inlineErrors = thisInlineErrors
+    if segmentSequences is None:
+        loadSchema(thisSchemaDir)
+
+
+def validateFileInWorker(messageFile):
+    '''
+    Validate one HL7 v2.x vertical bar encoded message in a worker process
+    PARAMETERS:
+        messageFile - str, the HL7 v2.x vertical bar encoded message file
+    RETURNS:
+        int, the exit status - EX_OK, or the status of any fatal error
+    '''
+
+    try:
+        validateFile(messageFile)
+    except SystemExit as e:
+        return e.code
+    return EX_OK
+
+
+if __name__ == '__main__':
+    '''
+    The main code
+    Start by parsing the command line arguements and setting up logging.
+    Then process each file name in the command line - read the HL7 v2.x vertical bar message
+    and convert it an HL7 v2.xml XML tagged message
+    '''
+
+    # Set the command line options
+    progName = sys.argv[0]
+    progName = progName[0:-3]        # Strip off the .py ending
+    parser = argparse.ArgumentParser(description='hl7Validator')
+    parser.add_argument('-I', '--inputDir', dest='inputDir',
+                        help='The folder containing the HL7 v2.x vertical bar encoded message files')
+    parser.add_argument('-i', '--inputFile', dest='inputFile',
+                        help='The name of the HL7 v2.x vertical bar encoded message file')
+    parser.add_argument ('-R', '--reportDir', dest='reportDir', default='.', metavar='reportDir',
+                         help='The name of the directory where the report(s) file will be created')
+    parser.add_argument('-O', '--outputDir', dest='outputDir', default='.',
+                        help='The folder where the HL7 v2.xml XML tagged message(s) will be created (default=".")')
+    parser.add_argument('-S', '--schemaDir', dest='schemaDir', required=True, default='schema/v2.4',
+                        help='The folder containing the HL7 v2.xml XML schema files (default="schema/v2.4")')
+    parser.add_argument ('-v', '--verbose', dest='verbose', type=int, choices=range(0,5),
+                         help='The level of logging\n\t0=CRITICAL,1=ERROR,2=WARNING,3=INFO,4=DEBUG')
+    parser.add_argument ('-L', '--logDir', dest='logDir', default='.', metavar='logDir',
+                         help='The name of the directory where the logging file will be created')
+    parser.add_argument ('-l', '--logFile', dest='logFile', metavar='logfile', help='The name of a logging file')
+    parser.add_argument ('-e', '--inlineErrors', dest='inlineErrors', action='store_true',
+                         help='Also add each validation error to the HL7 v2.xml XML message as an XML comment')
+    parser.add_argument ('-j', '--jobs', dest='jobs', type=int, default=1,
+                         help='The number of messages to validate in parallel (default=1, 0=one per CPU)')
+
+    # Parse the command line
+    args = parser.parse_args()
+    inputDir = args.inputDir
+    inputFile = args.inputFile
+    reportDir = args.reportDir
+    outputDir = args.outputDir
+    schemaDir = args.schemaDir
+    logDir = args.logDir
+    logFile = args.logFile
+    loggingLevel = args.verbose
+    inlineErrors = args.inlineErrors
+    jobs = args.jobs
+
+    # Set up logging
+    logging_levels = {0:logging.CRITICAL, 1:logging.ERROR, 2:logging.WARNING, 3:logging.INFO, 4:logging.DEBUG}
+    logfmt = progName + ' [%(asctime)s]: %(message)s'
+    logConfig = {'format': logfmt, 'datefmt': '%d/%m/%y %H:%M:%S %p'}      # Also used to set up logging in any worker processes
+    if loggingLevel is not None:    # Change the logging level from "WARN" if the -v vebose option is specified
+        logConfig['level'] = logging_levels[loggingLevel]
+    if logFile is not None:        # and send it to a file if the -o logfile option is specified
+        with open(os.path.join(logDir, logFile), 'wt', encoding='utf-8', newline='') as logOutput:
+            pass
+        logConfig['filename'] = os.path.join(logDir, logFile)
+    logging.basicConfig(**logConfig)
+    logging.debug('Logging set up')
+
+    # Read in the XML Schemas and tables
+    loadSchema(schemaDir)
+
+    # If inputFile is specified and is '-', then read one HL7 v2.x vertical bar encoded message from standard input
+    # If inputFile is specified and is not '-', and inputDir is None then read one HL7 v2.x vertical bar encoded message from ./inputFile.
+    # If inputFile is specified and is not '-', and inputDir is not None then read one HL7 v2.x vertical bar encoded message from inputDir/inputFile.
+    # If both inputFile and inputDir are not specified, then read one HL7 v2.x vertical bar encoded message from standard input.
+    # If inputFile is not specified, but inputDir is specified, then read one HL7 v2.x vertical bar encoded message for every file in inputDir.
+
+    # If one HL7 v2.x vertical bar encoded message is read from standard input, then output the report to stdout.
+    # Otherwise use the basename of filename, with the extension changed to '.rpt' to create the reportFile filename.
+    # If reportDir is specified, then create the file as reportDir/reportFile.rpt
+    # If reportDir is not specified, then create the file as inputDir/reportFile.rpt
+    hl7MessageFiles = []
+    if inputFile is not None:
+        if inputFile == '-':
+            hl7MessageFiles.append('-')
+        elif inputDir is None:
+            hl7MessageFiles.append(inputFile)
         else:
-            logging.info(s)
-            basename = os.path.basename(messageFile)
-            name, ext = os.path.splitext(basename)
-            outputFile = name + '.xml'
-            if outputDir is not None:
-                outputFile = os.path.join(outputDir, outputFile)
-            elif outputFile == messageFile:
-                outputFile = 'XML_' + outputFile
-            with open(outputFile, 'wt', encoding='utf-8', newline='') as fpout:
-                print(s, file=fpout)
+            hl7MessageFiles.append(os.path.join(inputDir, inputFile))
+    else:
+        if inputDir is None:
+            hl7MessageFiles.append('-')
+        else:
+            for thisFile in os.listdir(inputDir):
+                hl7MessageFiles.append(os.path.join(inputDir, thisFile))
+
+    # Process each of these HL7 v2.x vertical bar encoded messages
+    if jobs == 0:
+        jobs = os.cpu_count() or 1       # os.cpu_count() is None if the number of CPUs cannot be determined
+    if (jobs > 1) and (len(hl7MessageFiles) > 1):        # Validate the messages in parallel
+        with multiprocessing.Pool(min(jobs, len(hl7MessageFiles)), initializer=initWorker,
+                                  initargs=(logConfig, schemaDir, inputDir, reportDir, outputDir, inlineErrors)) as pool:
+            for exitCode in pool.imap_unordered(validateFileInWorker, hl7MessageFiles):
+                if exitCode != EX_OK:
+                    pool.terminate()
+                    logging.shutdown()
+                    sys.exit(exitCode)
+    else:
+        for messageFile in hl7MessageFiles:
+            validateFile(messageFile)